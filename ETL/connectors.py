@@ -4,7 +4,17 @@ import sqlalchemy
 import yaml
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.errors
+from psycopg2 import sql
 import io
+import os
+import re
+import json
+import hashlib
+import uuid
+import weakref
+import threading
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -12,7 +22,9 @@ from sqlalchemy.ext.declarative import declarative_base
 from pyhive import presto, trino
 
 from enum import Enum
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from collections.abc import Iterator
 from typing import Dict, Tuple, Union, Type, Sequence, Iterator, Optional, Any
 from abc import abstractmethod
@@ -36,6 +48,62 @@ def clean_csv_value(value: Optional[Any]) -> str:
     return str(value).replace('\r', ' ').replace('^', '/').replace('\n', '\\n').replace('\\', '/')
 
 
+def bind_positional(query: str) -> Tuple[str, Tuple[str]]:
+    '''
+    Rewrites :name placeholders into postgres $1, $2, ... skipping string literals,
+    quoted identifiers and comments
+
+    :param query: query template with :name placeholders
+    :returns (query, names): rewritten query and parameter names in positional order
+    '''
+    names = []
+
+    def to_position(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    parts = re.split(r'''('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)''', query, flags=re.S)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'(?<![:\w]):(\w+)', to_position, parts[i])
+    return ''.join(parts), tuple(names)
+
+
+def parse_partition_bound(bound: str) -> Tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]:
+    '''
+    Parses pg_get_expr(relpartbound) of a range partition on a single date/timestamp column
+
+    :param bound: e.g. FOR VALUES FROM ('2023-01-01 00:00:00') TO ('2023-02-01 00:00:00')
+    :returns (lower, upper): None stands for MINVALUE/MAXVALUE, both are None for a DEFAULT partition
+    '''
+    if bound.strip().upper() == 'DEFAULT':
+        return None, None
+    match = re.search(r'FROM \((.+?)\) TO \((.+?)\)', bound)
+    if match is None:
+        raise Exception(f'Not a range partition bound: {bound}')
+
+    def to_timestamp(value: str) -> Optional[pd.Timestamp]:
+        value = value.strip()
+        if value.upper() in ('MINVALUE', 'MAXVALUE'):
+            return None
+        timestamp = pd.Timestamp(value.strip("'"))
+        return timestamp.tz_localize(None) if timestamp.tzinfo is not None else timestamp
+
+    return to_timestamp(match.group(1)), to_timestamp(match.group(2))
+
+
+def overlaps_day(bounds: Sequence[Tuple[Optional[pd.Timestamp], Optional[pd.Timestamp]]], day: pd.Timestamp) -> bool:
+    '''
+    :param bounds: (lower, upper) pairs as returned by parse_partition_bound
+    :returns overlaps: whether any of the partitions holds rows of the given day
+    '''
+    next_day = day + timedelta(days=1)
+    return any(
+        (lower is None or lower < next_day) and (upper is None or upper > day)
+        for lower, upper in bounds
+    )
+
+
 class StringIteratorIO(io.TextIOBase):
     def __init__(self, iter: Iterator[str]):
         self._iter = iter
@@ -77,12 +145,218 @@ class TransactionStatus(Enum):
     Fail = 0
 
 
+class QueryCache:
+    '''
+    On-disk cache of query results
+
+    Every result is stored as a gzip-compressed column-oriented DataFrame file next to
+    a small json with its metadata. Entries expire after ttl, the least recently read
+    ones are evicted when the cache grows over max_size_bytes, and entries can be
+    invalidated by any table the cached query reads from. Entries are keyed by the
+    connection identity as well, so connectors with different credentials never share
+    results.
+
+    Cached results are unpickled on read: cache_dir must not be writable by anyone
+    but the user running the queries.
+    '''
+    # after these a FROM list is over; a comma no longer introduces a table
+    FROM_LIST_END = {
+        'where', 'group', 'order', 'limit', 'having', 'union', 'intersect', 'except',
+        'window', 'offset', 'fetch', 'select', 'qualify'
+    }
+    def __init__(self, cache_dir: str, ttl: timedelta = timedelta(hours=12), max_size_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        '''
+        Strips comments and collapses whitespace outside of string literals
+
+        :param query: raw sql
+        :returns normalized_query: sql that differs only for semantically different queries
+        '''
+        parts = re.split(r"('(?:[^']|'')*')", query)
+        for i in range(0, len(parts), 2):
+            part = re.sub(r'--[^\n]*', ' ', parts[i])
+            part = re.sub(r'/\*.*?\*/', ' ', part, flags=re.S)
+            parts[i] = ' '.join(part.split())
+        return ' '.join(part for part in parts if part).strip().rstrip(';').strip()
+
+    @staticmethod
+    def is_cacheable(query: str) -> bool:
+        '''
+        Only plain reads are cached: replaying a cached INSERT/DELETE would skip its execution
+        '''
+        return re.match(r'(select|with)\b', QueryCache.normalize_query(query), flags=re.I) is not None
+
+    @staticmethod
+    def referenced_tables(query: str) -> Tuple[str]:
+        '''
+        Finds the tables a query reads from: FROM lists (including comma-separated ones)
+        and JOINs of the query and its subqueries. CTE names and FROM inside function
+        calls like extract(day from created_at) are skipped.
+
+        :returns tables: lowercased table names, '*' among them if the list may be incomplete
+            (table functions, parenthesized joins, VALUES lists)
+        '''
+        query = re.sub(r"'(?:[^']|'')*'", "''", QueryCache.normalize_query(query))
+        tokens = re.findall(r'(?:"[^"]*"|\w+)(?:\.(?:"[^"]*"|\w+))*|[^\s\w]', query)
+        lowered = [token.lower() for token in tokens]
+
+        def opens_query(i: int) -> bool:
+            return i + 1 < len(tokens) and lowered[i + 1] in ('select', 'with')
+
+        # one frame per open parenthesis: whether it holds a (sub)query and whether a FROM list is open in it
+        frames = [{'query': True, 'from_list': False}]
+        tables, ctes = set(), set()
+        uncertain = expect_table = False
+        for i, token in enumerate(tokens):
+            word = lowered[i]
+            if expect_table:
+                if word == 'only':
+                    continue
+                expect_table = False
+                is_name = re.match(r'"|\w', token) is not None and word not in ('lateral', 'select', 'values')
+                if is_name and not (i + 1 < len(tokens) and tokens[i + 1] == '('):
+                    tables.add(token.replace('"', '').lower())
+                    continue
+                if not (token == '(' and opens_query(i)):
+                    uncertain = True
+
+            if token == '(':
+                frames.append({'query': opens_query(i), 'from_list': False})
+            elif token == ')':
+                if len(frames) > 1:
+                    frames.pop()
+            elif not frames[-1]['query']:
+                continue
+            elif word in ('from', 'join'):
+                frames[-1]['from_list'] = expect_table = True
+            elif token == ',' and frames[-1]['from_list']:
+                expect_table = True
+            elif word in QueryCache.FROM_LIST_END:
+                frames[-1]['from_list'] = False
+            elif (
+                i + 2 < len(tokens) and lowered[i + 1] == 'as' and tokens[i + 2] == '('
+                and i > 0 and lowered[i - 1] in ('with', 'recursive', ',')
+            ):
+                ctes.add(token.replace('"', '').lower())
+
+        tables -= ctes
+        if uncertain:
+            tables.add('*')
+        return tuple(sorted(tables))
+
+    def _key(self, query: str, params: Optional[dict], identity: str) -> str:
+        payload = json.dumps([identity, self.normalize_query(query), params or {}], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.cache_dir, f'{key}.pkl.gz'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def _remove(self, key: str):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, query: str, params: Optional[dict] = None, identity: str = '') -> Optional[Tuple[dict]]:
+        '''
+        :param identity: who runs the query (login@host), results are not shared between identities
+        :returns results: cached results tuple or None if there is no fresh entry
+        '''
+        key = self._key(query, params, identity)
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if datetime.now() - datetime.fromisoformat(meta['created_at']) > self.ttl:
+                self._remove(key)
+                return None
+            frame = pd.read_pickle(data_path, compression='gzip')
+            os.utime(data_path)
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            logger.error(f'{datetime.now()},unreadable cache entry {key}: {error}')
+            self._remove(key)
+            return None
+        return tuple(frame.to_dict(orient='records'))
+
+    def put(self, query: str, results: Tuple[dict], params: Optional[dict] = None, identity: str = ''):
+        key = self._key(query, params, identity)
+        data_path, meta_path = self._paths(key)
+        meta = {
+            'query': self.normalize_query(query),
+            'tables': self.referenced_tables(query),
+            'created_at': datetime.now().isoformat(),
+        }
+        try:
+            pd.DataFrame(list(results), dtype=object).to_pickle(f'{data_path}.tmp', compression='gzip')
+            os.replace(f'{data_path}.tmp', data_path)
+            with open(f'{meta_path}.tmp', 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.replace(f'{meta_path}.tmp', meta_path)
+            self._evict()
+        except Exception as error:
+            logger.error(f'{datetime.now()},could not cache query result: {error}')
+            self._remove(key)
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl.gz'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[:-len('.pkl.gz')]))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            self._remove(key)
+            total_size -= size
+
+    def invalidate(self, table: Optional[str] = None) -> int:
+        '''
+        Drops cached entries
+
+        :param table: drop only entries reading from this table ('schema.table' or just 'table'), all if None
+        :returns removed: number of dropped entries
+        '''
+        table = table.replace('"', '').lower() if table else None
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            if table is not None:
+                try:
+                    with open(os.path.join(self.cache_dir, name)) as meta_file:
+                        tables = json.load(meta_file)['tables']
+                except FileNotFoundError:
+                    continue
+                except (ValueError, KeyError):
+                    tables = [table]
+                if not any(t == '*' or t == table or t.endswith(f'.{table}') for t in tables):
+                    continue
+            self._remove(key)
+            removed += 1
+        return removed
+
+
 class Connector:
     '''
     Base class for getting a db session and performing queries
     '''
     def __init__(self, creds: dict):
         self.creds = creds
+        self.templates = {}
 
     @abstractmethod
     def _get_engine(self) -> sqlalchemy.engine.Engine:
@@ -120,11 +394,12 @@ class Connector:
             logger.info(f'{datetime.now()},query performed')
             return TransactionStatus.Success
 
-    def query(self, query: str) -> Dict[str, Union[TransactionStatus, Tuple[dict]]]:
+    def query(self, query: str, params: Optional[dict] = None) -> Dict[str, Union[TransactionStatus, Tuple[dict]]]:
         '''
         Only performs data manipulation (SELECT) queries
 
         :param query: DML query (SELECT * FROM table)
+        :param params: values for :name placeholders in query
         :returns transaction_result: dict with a query's status and results tuple if received any
         '''
         if 'CREATE TABLE' in query or 'DROP TABLE' in query:
@@ -132,7 +407,7 @@ class Connector:
 
         db = self._get_session()
         try:
-            resultproxy = db.execute(query)
+            resultproxy = db.execute(sqlalchemy.text(query), params) if params else db.execute(query)
             result = tuple({column:value for column, value in rowproxy.items()} for rowproxy in resultproxy)
         except Exception as error:
             logger.error(f'{datetime.now()},{error}')
@@ -144,12 +419,70 @@ class Connector:
             return transaction_result
 
 
+    def register_query(self, name: str, query: str):
+        '''
+        Adds a named query template to the connector's registry
+
+        :param name: template name, a valid sql identifier
+        :param query: query with :name placeholders for bound parameters; on LookupConnector
+            a parameter whose type postgres cannot infer from context needs a cast (:day::date)
+        '''
+        if not re.fullmatch(r'[A-Za-z_]\w*', name):
+            raise Exception(f'Not a valid template name: {name}')
+        self.templates[name] = query
+
+    def query_template(self, name: str, params: Optional[dict] = None) -> Dict[str, Union[TransactionStatus, Tuple[dict]]]:
+        '''
+        Performs a registered query template with bound parameters
+
+        :param name: name given to register_query
+        :param params: values for the template's placeholders
+        :returns transaction_result: dict with a query's status and results tuple if received any
+        '''
+        return self.query(self.templates[name], params)
+
+    def query_template_many(self, name: str, params_seq: Sequence[dict]) -> Dict[str, Union[TransactionStatus, Tuple[dict]]]:
+        '''
+        Performs a registered query template once per parameter set, e.g. once per day of a window
+
+        :param params_seq: sequence of values for the template's placeholders
+        :returns transaction_result: dict with a status and results tuple of all executions concatenated
+        '''
+        results = []
+        for params in params_seq:
+            transaction_result = self.query_template(name, params)
+            if transaction_result['status'] == TransactionStatus.Fail:
+                return transaction_result
+            results.extend(transaction_result['results'])
+        return {'status': TransactionStatus.Success, 'results': tuple(results)}
+
+
 class LookupConnector(Connector):
     '''
     A class for performing queries to lookups db
+
+    Registered query templates and inserts share a lazily opened pool of up to
+    pool_size connections; callers over that limit wait for a free one. Templates are
+    run as server-side prepared statements: every template is parsed and planned once
+    per pooled connection and later executions only bind parameters. One connection
+    stays open between calls; extra ones opened under concurrency are closed when
+    returned, and their prepared statements are forgotten with them.
     '''
-    def __init__(self, creds: dict) -> None:
+    def __init__(self, creds: dict, pool_size: int = 4) -> None:
         super().__init__(creds=creds)
+        self.pool_size = pool_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self._prepared = weakref.WeakKeyDictionary()
+        self.register_query(
+            'table_fields',
+            '''SELECT column_name
+               FROM information_schema.columns
+               WHERE table_schema = :schema
+               AND table_name     = :table
+               ORDER BY ordinal_position;'''
+        )
 
     def _get_connection(self):
         '''
@@ -158,51 +491,350 @@ class LookupConnector(Connector):
         :returns connection: psycopg2 connection
         '''
         try:
-            connection = psycopg2.connect(
-                host='postgres-lookups-master.spb.play.dc',
-                port=5433, # new 6432
-                database='lookups',
-                user=self.creds['login'],
-                password=self.creds['password']
-            )
+            connection = psycopg2.connect(**self._connection_params())
         except Exception as error:
             logger.error(f'{datetime.now()},{error}')
         else:
             return connection
 
-    def _get_table_fields(self, schema: str, table: str):
-        connection = self._get_connection()
-        connection.autocommit = True
+    def _connection_params(self) -> dict:
+        return dict(
+            host='postgres-lookups-master.spb.play.dc',
+            port=5433, # new 6432
+            database='lookups',
+            user=self.creds['login'],
+            password=self.creds['password']
+        )
+
+    def _get_pool(self, n_connections: int, min_connections: int = 1) -> psycopg2.pool.ThreadedConnectionPool:
+        '''
+        Initializes a thread-safe pool of psycopg2 connections to lookups db
+
+        :param n_connections: max number of simultaneously opened connections
+        :param min_connections: number of connections kept open when returned to the pool
+        :returns pool: psycopg2 ThreadedConnectionPool
+        '''
+        return psycopg2.pool.ThreadedConnectionPool(
+            minconn=min_connections, maxconn=n_connections, **self._connection_params()
+        )
+
+    def _get_shared_pool(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._pool_lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = self._get_pool(n_connections=self.pool_size)
+                self._prepared = weakref.WeakKeyDictionary()
+            return self._pool
+
+    @contextmanager
+    def _pooled_connection(self):
+        '''
+        Borrows an autocommit connection from the shared pool, waiting while all of them are busy
+        '''
+        with self._pool_slots:
+            pool = self._get_shared_pool()
+            connection = pool.getconn()
+            broken = False
+            try:
+                connection.autocommit = True
+                yield connection
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                self._prepared.pop(connection, None)
+                raise
+            finally:
+                pool.putconn(connection, close=broken)
+
+    def close(self):
+        '''
+        Closes pooled connections together with their prepared statements
+        '''
+        if self._pool is not None and not self._pool.closed:
+            self._pool.closeall()
+        self._prepared = weakref.WeakKeyDictionary()
+
+    def _prepare(self, cursor, prepared: dict, name: str, query: str):
+        if name in prepared:
+            cursor.execute(sql.SQL('DEALLOCATE {}').format(sql.Identifier(name)))
+            del prepared[name]
+        statement = sql.SQL('PREPARE {} AS ').format(sql.Identifier(name)) + sql.SQL(query)
+        try:
+            cursor.execute(statement)
+        except psycopg2.errors.DuplicatePreparedStatement:
+            cursor.execute(sql.SQL('DEALLOCATE {}').format(sql.Identifier(name)))
+            cursor.execute(statement)
+        prepared[name] = query
+
+    def _execute_prepared(self, name: str, params_seq: Sequence[Optional[dict]]) -> Tuple[tuple]:
+        '''
+        Executes a registered template as a prepared statement once per parameter set
+
+        The statement is prepared on first use on a pooled connection (or when its
+        template changed) and reused by all later executions on that connection.
+
+        :returns results: fetched rows of all executions concatenated
+        '''
+        query, names = bind_positional(self.templates[name])
+        with self._pooled_connection() as connection:
+            prepared = self._prepared.setdefault(connection, {})
+            results = []
+            with connection.cursor() as cursor:
+                if prepared.get(name) != query:
+                    self._prepare(cursor, prepared, name, query)
+
+                execute = sql.SQL('EXECUTE {}').format(sql.Identifier(name))
+                if names:
+                    execute += sql.SQL(' ({})').format(sql.SQL(', ').join(sql.Placeholder() * len(names)))
+                for params in params_seq:
+                    values = [(params or {})[key] for key in names]
+                    try:
+                        cursor.execute(execute, values)
+                    except psycopg2.errors.InvalidSqlStatementName:
+                        # the server lost the statement (e.g. DISCARD ALL by a pooler), prepare it again
+                        prepared.pop(name, None)
+                        self._prepare(cursor, prepared, name, query)
+                        cursor.execute(execute, values)
+                    if cursor.description is not None:
+                        results.extend(cursor.fetchall())
+            return tuple(results)
+
+    def query_template(self, name: str, params: Optional[dict] = None) -> Dict[str, Union[TransactionStatus, Tuple[tuple]]]:
+        '''
+        Performs a registered query template as a prepared statement with bound parameters
+
+        :param name: name given to register_query
+        :param params: values for the template's placeholders
+        :returns transaction_result: dict with a query's status and results tuple if received any
+        '''
+        return self.query_template_many(name, (params,))
+
+    def query_template_many(self, name: str, params_seq: Sequence[dict]) -> Dict[str, Union[TransactionStatus, Tuple[tuple]]]:
+        '''
+        Performs a registered query template once per parameter set on a single pooled
+        connection, e.g. a per-day lookup over a window of days
+
+        :param params_seq: sequence of values for the template's placeholders
+        :returns transaction_result: dict with a status and results tuple of all executions concatenated
+        '''
+        try:
+            result = self._execute_prepared(name, params_seq)
+        except Exception as error:
+            logger.error(f'{datetime.now()},{error}')
+            return {'status': TransactionStatus.Fail, 'results': None}
+        else:
+            logger.info(f'{datetime.now()},query performed')
+            return {'status': TransactionStatus.Success, 'results': result}
 
-        with connection.cursor() as cursor:
-            cursor.execute(
-            f'''SELECT *
-                FROM information_schema.columns
-                WHERE table_schema = '{schema}'
-                AND table_name     = '{table}';'''
-           )
-            raw_result = cursor.fetchall()
-        table_fields = [row[3] for row in raw_result]
+    def _get_table_fields(self, schema: str, table: str):
+        transaction_result = self.query_template('table_fields', {'schema': schema, 'table': table})
+        if transaction_result['status'] == TransactionStatus.Fail:
+            raise Exception(f'Could not get fields of {schema}.{table}')
+        table_fields = [row[0] for row in transaction_result['results']]
 
         return table_fields
 
     def insert(self, schema: str, table: str, data: Union[pd.DataFrame, Iterator]):
-        connection = self._get_connection()
-        connection.autocommit = True
         table_fields = self._get_table_fields(schema=schema, table=table)
 
         if type(data) == pd.DataFrame:
             data = (row for row in data.to_dict(orient='records'))
 
-        with connection.cursor() as cursor:
-            string_iterator = StringIteratorIO(
-                (
-                    '^'.join(map(clean_csv_value, tuple(datum[key] for key in table_fields))) + '\n' for datum in data
+        with self._pooled_connection() as connection, connection.cursor() as cursor:
+            self._copy_rows(cursor=cursor, schema=schema, table=table, table_fields=table_fields, data=data)
+
+    def _copy_rows(self, cursor, schema: str, table: str, table_fields: Sequence[str], data: Iterator):
+        string_iterator = StringIteratorIO(
+            (
+                '^'.join(map(clean_csv_value, tuple(datum[key] for key in table_fields))) + '\n' for datum in data
+            )
+        )
+        cursor.copy_expert(
+            sql.SQL("COPY {}.{} FROM STDIN WITH (DELIMITER '^')").format(sql.Identifier(schema), sql.Identifier(table)),
+            string_iterator
+        )
+
+    def _shard_data(self, data: pd.DataFrame, shard_key: str, shard_by: str, n_shards: int) -> Dict[Any, pd.DataFrame]:
+        '''
+        Splits a dataset into independent shards for parallel loading
+
+        :param shard_key: column to shard by
+        :param shard_by: 'day' - one shard per calendar day of shard_key, 'hash' - n_shards shards by hash of shard_key
+        :returns shards: dict of shard label -> DataFrame, rows with an empty key by day go to the NaT shard
+        '''
+        if shard_by == 'day':
+            labels = pd.to_datetime(data[shard_key]).dt.floor('D')
+        elif shard_by == 'hash':
+            labels = pd.util.hash_pandas_object(data[shard_key], index=False) % n_shards
+        else:
+            raise Exception(f'Unknown shard_by: {shard_by}')
+        return {label: shard for label, shard in data.groupby(labels.values, sort=True, dropna=False)}
+
+    def _copy_shard(self, pool: psycopg2.pool.ThreadedConnectionPool, schema: str, table: str,
+                    table_fields: Sequence[str], shard: pd.DataFrame) -> int:
+        connection = pool.getconn()
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                self._copy_rows(
+                    cursor=cursor, schema=schema, table=table, table_fields=table_fields,
+                    data=shard.to_dict(orient='records')
                 )
+        finally:
+            pool.putconn(connection)
+        return len(shard)
+
+    def _get_partition_bounds(self, cursor, schema: str, table: str) -> list:
+        cursor.execute(
+            '''SELECT pg_get_expr(c.relpartbound, c.oid)
+               FROM pg_inherits i
+               JOIN pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = to_regclass(%(parent)s);''',
+            {'parent': f'{schema}.{table}'}
+        )
+        return [parse_partition_bound(row[0]) for row in cursor.fetchall()]
+
+    def parallel_insert(self, schema: str, table: str, data: pd.DataFrame, shard_key: str,
+                        n_connections: int = 4, shard_by: str = 'hash',
+                        partitioned: bool = False) -> TransactionStatus:
+        '''
+        Loads a dataset with several concurrent COPY streams, one per pooled connection
+
+        Data is split into shards by shard_key (see _shard_data) and every shard is
+        copied straight into the target by its own backend process and committed on its
+        own, so a bulk backfill scales with server cores instead of being bound by a
+        single COPY. The load is not atomic as a whole: if some shards fail, the others
+        stay committed and both are logged by label. Sharding is deterministic for the same
+        shard_by and n_connections, so only the failed shards should be reloaded.
+
+        With partitioned=True the target must be declared PARTITION BY RANGE (shard_key)
+        on a date/timestamp column and data is sharded by day. A day that no existing
+        partition (including a DEFAULT one) overlaps is copied into a new table
+        {table}_pYYYYMMDD with a CHECK constraint matching the partition bounds, so that
+        ATTACH PARTITION can rely on it instead of validating the rows. All new partitions
+        are attached together in one transaction once every one of them is loaded;
+        otherwise none are attached and they are dropped. Other days, including rows with
+        an empty shard_key, are copied through the parent table.
+
+        :param shard_key: column to shard by (e.g. created_at or ticket_id)
+        :param n_connections: number of concurrent COPY streams
+        :param shard_by: 'hash' or 'day'
+        :param partitioned: attach missing days as new daily partitions
+        :returns transaction_status: Success if every shard was loaded
+        '''
+        if partitioned and shard_by != 'day':
+            raise Exception('Partitioned load requires shard_by="day"')
+
+        if data.empty:
+            return TransactionStatus.Success
+
+        table_fields = self._get_table_fields(schema=schema, table=table)
+        shards = self._shard_data(data=data, shard_key=shard_key, shard_by=shard_by, n_shards=n_connections)
+
+        # one more connection than COPY streams: it is kept for DDL and the attach transaction
+        pool = self._get_pool(n_connections=n_connections + 1)
+        targets = {label: table for label in shards}
+        new_partitions = {}
+        loaded, failed = {}, {}
+        connection = pool.getconn()
+        try:
+            connection.autocommit = True
+            if partitioned:
+                with connection.cursor() as cursor:
+                    bounds = self._get_partition_bounds(cursor, schema, table)
+                    for label in shards:
+                        if pd.isna(label) or overlaps_day(bounds, label):
+                            continue
+                        partition = f'{table}_p{label:%Y%m%d}'
+                        cursor.execute(
+                            sql.SQL(
+                                '''CREATE TABLE {schema}.{partition}
+                                   (LIKE {schema}.{table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+                                   ALTER TABLE {schema}.{partition}
+                                   ADD CONSTRAINT {bounds}
+                                   CHECK ({key} IS NOT NULL AND {key} >= {day_from} AND {key} < {day_to});'''
+                            ).format(
+                                schema=sql.Identifier(schema), table=sql.Identifier(table),
+                                partition=sql.Identifier(partition), bounds=sql.Identifier(f'{partition}_bounds'),
+                                key=sql.Identifier(shard_key),
+                                day_from=sql.Literal(f'{label:%Y-%m-%d}'),
+                                day_to=sql.Literal(f'{label + timedelta(days=1):%Y-%m-%d}')
+                            )
+                        )
+                        targets[label] = partition
+                        new_partitions[label] = partition
+
+            with ThreadPoolExecutor(max_workers=n_connections) as executor:
+                futures = {
+                    label: executor.submit(self._copy_shard, pool, schema, targets[label], table_fields, shard)
+                    for label, shard in shards.items()
+                }
+            for label, future in futures.items():
+                try:
+                    loaded[label] = future.result()
+                except Exception as error:
+                    failed[label] = error
+
+            if new_partitions and not any(label in failed for label in new_partitions):
+                connection.autocommit = False
+                with connection.cursor() as cursor:
+                    for day, partition in new_partitions.items():
+                        cursor.execute(
+                            sql.SQL(
+                                '''ALTER TABLE {schema}.{table} ATTACH PARTITION {schema}.{partition}
+                                   FOR VALUES FROM ({day_from}) TO ({day_to});
+                                   ALTER TABLE {schema}.{partition} DROP CONSTRAINT {bounds};'''
+                            ).format(
+                                schema=sql.Identifier(schema), table=sql.Identifier(table),
+                                partition=sql.Identifier(partition), bounds=sql.Identifier(f'{partition}_bounds'),
+                                day_from=sql.Literal(f'{day:%Y-%m-%d}'),
+                                day_to=sql.Literal(f'{day + timedelta(days=1):%Y-%m-%d}')
+                            )
+                        )
+                connection.commit()
+                connection.autocommit = True
+                new_partitions = {}
+            elif new_partitions:
+                for label in new_partitions:
+                    failed.setdefault(label, Exception('not attached'))
+                    loaded.pop(label, None)
+                self._drop_tables(connection, schema, new_partitions.values())
+        except Exception as error:
+            logger.error(f'{datetime.now()},{error},committed shards: {[l for l in loaded if l not in new_partitions]}')
+            try:
+                if not connection.autocommit:
+                    connection.rollback()
+                    connection.autocommit = True
+            except Exception as rollback_error:
+                logger.error(f'{datetime.now()},{rollback_error}')
+            self._drop_tables(connection, schema, new_partitions.values())
+            return TransactionStatus.Fail
+        else:
+            logger.info(
+                f'{datetime.now()},{sum(loaded.values())} rows copied in {len(loaded)} of {len(shards)} shards'
             )
-#             cursor.copy_expert(f"COPY {schema}.{table} FROM STDIN", string_iterator)
-            cursor.execute(f'SET search_path TO {schema}')
-            cursor.copy_from(string_iterator, f'{table}', sep='^')
+            if failed:
+                logger.error(
+                    f'{datetime.now()},committed shards: {list(loaded)},'
+                    f'failed shards: {", ".join(f"{label}: {error}" for label, error in failed.items())}'
+                )
+                return TransactionStatus.Fail
+            return TransactionStatus.Success
+        finally:
+            pool.putconn(connection)
+            pool.closeall()
+
+    def _drop_tables(self, connection, schema: str, tables: Iterator[str]):
+        '''
+        Drops tables created by a failed load, logging instead of raising if it cannot
+        '''
+        tables = list(tables)
+        try:
+            with connection.cursor() as cursor:
+                for table in tables:
+                    cursor.execute(
+                        sql.SQL('DROP TABLE IF EXISTS {}.{}').format(sql.Identifier(schema), sql.Identifier(table))
+                    )
+        except Exception as error:
+            logger.error(f'{datetime.now()},{error},tables left in {schema}: {", ".join(tables)}')
 
     def ddl_query(self, query: str) -> TransactionStatus:
         '''
@@ -254,9 +886,37 @@ class LookupConnector(Connector):
 class PrestoConnector(Connector):
     '''
     A class for performing queries to presto
+
+    Pass a QueryCache to reuse results of repeated analytical queries
     '''
-    def __init__(self, creds: dict) -> None:
+    def __init__(self, creds: dict, cache: Optional[QueryCache] = None) -> None:
         super().__init__(creds=creds)
+        self.cache = cache
+
+    def query(self, query: str, params: Optional[dict] = None,
+              use_cache: bool = True) -> Dict[str, Union[TransactionStatus, Tuple[dict]]]:
+        '''
+        Performs a SELECT query, serving it from cache if one is set and holds a fresh result
+
+        :param query: DML query (SELECT * FROM table)
+        :param params: values for :name placeholders in query, part of the cache key
+        :param use_cache: set False to force execution and refresh the cached result
+        :returns transaction_result: dict with a query's status and results tuple if received any
+        '''
+        cacheable = self.cache is not None and QueryCache.is_cacheable(query)
+        if cacheable and use_cache:
+            result = self.cache.get(query, params, self._cache_identity())
+            if result is not None:
+                logger.info(f'{datetime.now()},query served from cache')
+                return {'status': TransactionStatus.Success, 'results': result}
+
+        transaction_result = super().query(query, params)
+        if cacheable and transaction_result['status'] == TransactionStatus.Success:
+            self.cache.put(query, transaction_result['results'], params, self._cache_identity())
+        return transaction_result
+
+    def _cache_identity(self) -> str:
+        return f"{self.creds.get('login')}@{self.creds.get('host')}:{self.creds.get('port')}"
 
     def _get_connection(self):
         try:
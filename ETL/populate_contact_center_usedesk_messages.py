@@ -24,8 +24,9 @@ lookup = LookupConnector(
 
 tickets_extract_query = '''
 select * from dashboards.contact_center_usedesk_tickets
-where created_at > '{date_from}' and created_at < '{date_to}';
+where created_at > :date_from and created_at < :date_to;
 '''
+lookup.register_query('tickets_extract', tickets_extract_query)
 
 
 def batch_insert_data(messages: pd.DataFrame):
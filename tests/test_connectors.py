@@ -0,0 +1,461 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+for module in ('pandas', 'sqlalchemy', 'psycopg2', 'pyhive', 'yaml'):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import creds.paths_for_scripts as paths_for_scripts  # noqa: E402
+
+paths_for_scripts.path_logs = os.path.join(tempfile.mkdtemp(), 'connectors.log')
+
+import pandas as pd  # noqa: E402
+import psycopg2.errors  # noqa: E402
+import psycopg2.pool  # noqa: E402
+from psycopg2 import sql  # noqa: E402
+
+from ETL.connectors import (  # noqa: E402
+    Connector, LookupConnector, PrestoConnector, QueryCache, TransactionStatus,
+    bind_positional, overlaps_day, parse_partition_bound
+)
+
+
+@pytest.fixture
+def lookup():
+    return LookupConnector(creds={'login': 'login', 'password': 'password'})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return QueryCache(cache_dir=str(tmp_path))
+
+
+def test_parse_partition_bound():
+    assert parse_partition_bound("FOR VALUES FROM ('2023-01-01 00:00:00') TO ('2023-02-01 00:00:00')") == (
+        pd.Timestamp('2023-01-01'), pd.Timestamp('2023-02-01')
+    )
+    assert parse_partition_bound("FOR VALUES FROM (MINVALUE) TO ('2023-01-01')") == (None, pd.Timestamp('2023-01-01'))
+    assert parse_partition_bound('DEFAULT') == (None, None)
+
+
+def test_overlaps_day():
+    monthly = [(pd.Timestamp('2023-01-01'), pd.Timestamp('2023-02-01'))]
+    assert overlaps_day(monthly, pd.Timestamp('2023-01-31'))
+    assert not overlaps_day(monthly, pd.Timestamp('2023-02-01'))
+    assert not overlaps_day(monthly, pd.Timestamp('2022-12-31'))
+    assert overlaps_day([(None, None)], pd.Timestamp('2023-05-05'))
+    assert not overlaps_day([], pd.Timestamp('2023-05-05'))
+
+
+def test_shard_data_by_day(lookup):
+    data = pd.DataFrame({
+        'ticket_id': [1, 2, 3],
+        'created_at': pd.to_datetime(['2023-01-01 10:00', '2023-01-01 23:59', '2023-01-02 00:00']),
+    })
+    shards = lookup._shard_data(data=data, shard_key='created_at', shard_by='day', n_shards=4)
+    assert list(shards) == [pd.Timestamp('2023-01-01'), pd.Timestamp('2023-01-02')]
+    assert shards[pd.Timestamp('2023-01-01')]['ticket_id'].tolist() == [1, 2]
+
+
+def test_shard_data_by_hash(lookup):
+    data = pd.DataFrame({'ticket_id': list(range(1000)) * 2})
+    shards = lookup._shard_data(data=data, shard_key='ticket_id', shard_by='hash', n_shards=4)
+    assert set(shards) <= set(range(4))
+    assert sum(len(shard) for shard in shards.values()) == len(data)
+    for shard in shards.values():
+        assert (shard['ticket_id'].value_counts() == 2).all()
+
+
+def test_shard_data_keeps_empty_keys(lookup):
+    data = pd.DataFrame({
+        'ticket_id': [1, 2, 3],
+        'created_at': pd.to_datetime(['2023-01-01 10:00', None, '2023-01-02 00:00']),
+    })
+    shards = lookup._shard_data(data=data, shard_key='created_at', shard_by='day', n_shards=4)
+    assert sum(len(shard) for shard in shards.values()) == len(data)
+    assert [shard['ticket_id'].tolist() for label, shard in shards.items() if pd.isna(label)] == [[2]]
+
+
+def test_shard_data_unknown_mode(lookup):
+    with pytest.raises(Exception):
+        lookup._shard_data(data=pd.DataFrame({'a': [1]}), shard_key='a', shard_by='range', n_shards=2)
+
+
+def test_normalize_query_keeps_literals():
+    query = "select a -- comment\n from  dashboards.t /* block */ where b = 'x  -- y';"
+    assert QueryCache.normalize_query(query) == "select a from dashboards.t where b = 'x  -- y'"
+    assert QueryCache.normalize_query("select 'a  b'") != QueryCache.normalize_query("select 'a b'")
+
+
+def test_referenced_tables():
+    query = 'SELECT * FROM dashboards.tickets t JOIN "Dashboards".messages m ON t.id = m.ticket_id'
+    assert QueryCache.referenced_tables(query) == ('dashboards.messages', 'dashboards.tickets')
+
+
+def test_referenced_tables_comma_join():
+    assert QueryCache.referenced_tables('select * from a x, b y where x.id = y.id') == ('a', 'b')
+    assert QueryCache.referenced_tables('select * from (select id from t1) s, t2') == ('t1', 't2')
+
+
+def test_referenced_tables_skips_function_from_and_ctes():
+    query = '''
+        with daily as (select extract(day from created_at) as d from dashboards.tickets)
+        select substring(d from 1 for 2) from daily
+    '''
+    assert QueryCache.referenced_tables(query) == ('dashboards.tickets',)
+
+
+def test_referenced_tables_uncertain():
+    assert QueryCache.referenced_tables('select * from t cross join unnest(ids) as u(id)') == ('*', 't')
+
+
+def test_is_cacheable():
+    assert QueryCache.is_cacheable('  -- daily\n SELECT 1')
+    assert QueryCache.is_cacheable('with x as (select 1) select * from x')
+    assert not QueryCache.is_cacheable('INSERT INTO t SELECT * FROM s')
+    assert not QueryCache.is_cacheable('delete from t')
+
+
+def test_cache_roundtrip_by_params(cache):
+    rows = ({'a': 1, 'b': None}, {'a': 2, 'b': 'x'})
+    cache.put('select a, b from t where d = :d', rows, {'d': '2023-01-01'})
+    assert cache.get('select a,  b from t where d = :d', {'d': '2023-01-01'}) == rows
+    assert cache.get('select a, b from t where d = :d', {'d': '2023-01-02'}) is None
+
+
+def test_cache_ttl(cache):
+    cache.put('select 1', ({'a': 1},))
+    _, meta_path = cache._paths(cache._key('select 1', None, ''))
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    meta['created_at'] = (datetime.now() - cache.ttl - timedelta(minutes=1)).isoformat()
+    with open(meta_path, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    assert cache.get('select 1') is None
+    assert not os.path.exists(meta_path)
+
+
+def test_cache_evicts_least_recently_read(cache):
+    rows = tuple({'a': i} for i in range(100))
+    cache.put('select * from a', rows)
+    cache.put('select * from b', rows)
+    data_a, _ = cache._paths(cache._key('select * from a', None, ''))
+    data_b, _ = cache._paths(cache._key('select * from b', None, ''))
+    os.utime(data_a, (1, 1))
+    os.utime(data_b, (2, 2))
+    assert cache.get('select * from a') == rows
+
+    cache.max_size_bytes = int(os.path.getsize(data_a) * 2.5)
+    cache.put('select * from c', rows)
+    assert cache.get('select * from b') is None
+    assert cache.get('select * from a') == rows
+    assert cache.get('select * from c') == rows
+
+
+def test_cache_corrupt_entry_is_a_miss(cache):
+    cache.put('select 1', ({'a': 1},))
+    data_path, _ = cache._paths(cache._key('select 1', None, ''))
+    with open(data_path, 'wb') as data_file:
+        data_file.write(b'not gzip')
+    assert cache.get('select 1') is None
+    assert not os.path.exists(data_path)
+
+
+def test_cache_put_failure_is_logged(cache, monkeypatch):
+    def disk_full(*args, **kwargs):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(pd.DataFrame, 'to_pickle', disk_full)
+    cache.put('select 1', ({'a': 1},))
+    assert cache.get('select 1') is None
+
+
+def test_cache_invalidate_by_table(cache):
+    cache.put('select * from dashboards.tickets', ({'a': 1},))
+    cache.put('select * from dashboards.messages', ({'a': 2},))
+    assert cache.invalidate('tickets') == 1
+    assert cache.get('select * from dashboards.tickets') is None
+    assert cache.get('select * from dashboards.messages') == ({'a': 2},)
+    assert cache.invalidate() == 1
+
+
+def test_cache_invalidate_uncertain_entry(cache):
+    cache.put('select * from (a join b on a.id = b.id)', ({'a': 1},))
+    assert cache.invalidate('anything') == 1
+
+
+def test_cache_separates_identities(cache):
+    cache.put('select 1', ({'a': 1},), identity='analyst@trino:8443')
+    assert cache.get('select 1', identity='analyst@trino:8443') == ({'a': 1},)
+    assert cache.get('select 1', identity='etl@trino:8443') is None
+
+
+def test_presto_query_caches_only_reads(cache, monkeypatch):
+    calls = []
+
+    def fake_query(self, query, params=None):
+        calls.append(query)
+        return {'status': TransactionStatus.Success, 'results': ({'a': 1},)}
+
+    monkeypatch.setattr(Connector, 'query', fake_query)
+    presto = PrestoConnector(creds={}, cache=cache)
+    for _ in range(2):
+        assert presto.query('select a from t')['results'] == ({'a': 1},)
+        presto.query('insert into t select a from s')
+    assert calls == ['select a from t', 'insert into t select a from s', 'insert into t select a from s']
+
+
+def test_bind_positional():
+    query, names = bind_positional(
+        "select x::int, '12:30 :no' as \"col :no\" from t -- :no\n"
+        "where a > :date_from /* :no */ and b < :date_to and c = :date_from"
+    )
+    assert names == ('date_from', 'date_to')
+    assert query == (
+        "select x::int, '12:30 :no' as \"col :no\" from t -- :no\n"
+        "where a > $1 /* :no */ and b < $2 and c = $1"
+    )
+
+
+def render(statement) -> str:
+    if isinstance(statement, sql.Composed):
+        return ''.join(render(part) for part in statement.seq)
+    if isinstance(statement, sql.Identifier):
+        return statement.strings[0]
+    if isinstance(statement, sql.Placeholder):
+        return '%s'
+    if isinstance(statement, sql.Literal):
+        return repr(statement.wrapped)
+    return statement.string
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, values=None):
+        text = render(statement)
+        self.connection.log.append(text.split()[0])
+        name = text.split()[1]
+        self.description = None
+        if text.startswith('PREPARE'):
+            self.connection.server_prepared.add(name)
+        elif text.startswith('DEALLOCATE'):
+            self.connection.server_prepared.discard(name)
+        elif name not in self.connection.server_prepared:
+            raise psycopg2.errors.InvalidSqlStatementName()
+        else:
+            self.description = ('column_name',)
+            self.rows = [(values[0],)]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    autocommit = False
+
+    def __init__(self):
+        self.log = []
+        self.server_prepared = set()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def getconn(self):
+        return self.connection
+
+    def putconn(self, connection, close=False):
+        pass
+
+
+def test_template_prepared_once_per_connection(lookup, monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(lookup, '_get_shared_pool', lambda: FakePool(connection))
+    lookup.register_query('by_day', 'select :day::int')
+
+    result = lookup.query_template_many('by_day', [{'day': 1}, {'day': 2}])
+    assert result == {'status': TransactionStatus.Success, 'results': ((1,), (2,))}
+    assert lookup.query_template('by_day', {'day': 3})['results'] == ((3,),)
+    assert connection.log == ['PREPARE', 'EXECUTE', 'EXECUTE', 'EXECUTE']
+
+
+def test_template_reprepared_when_lost_on_server(lookup, monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(lookup, '_get_shared_pool', lambda: FakePool(connection))
+    lookup.register_query('by_day', 'select :day::int')
+    lookup.query_template('by_day', {'day': 1})
+
+    connection.server_prepared.clear()
+    assert lookup.query_template('by_day', {'day': 2})['results'] == ((2,),)
+    assert connection.log == ['PREPARE', 'EXECUTE', 'EXECUTE', 'PREPARE', 'EXECUTE']
+
+
+def test_pooled_connection_waits_for_free_slot(monkeypatch):
+    lookup = LookupConnector(creds={'login': 'login', 'password': 'password'}, pool_size=1)
+    borrowed = []
+
+    class SingleConnectionPool(FakePool):
+        def getconn(self):
+            if borrowed:
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+            borrowed.append(self.connection)
+            return self.connection
+
+        def putconn(self, connection, close=False):
+            borrowed.remove(connection)
+
+    pool = SingleConnectionPool(FakeConnection())
+    monkeypatch.setattr(lookup, '_get_shared_pool', lambda: pool)
+    errors = []
+
+    def borrow():
+        try:
+            with lookup._pooled_connection():
+                time.sleep(0.05)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=borrow) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_template_missing_param_fails(lookup, monkeypatch):
+    monkeypatch.setattr(lookup, '_get_shared_pool', lambda: FakePool(FakeConnection()))
+    lookup.register_query('by_day', 'select :day::int')
+    assert lookup.query_template('by_day', {})['status'] == TransactionStatus.Fail
+
+
+class LoadCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, statement, params=None):
+        text = render(statement) if isinstance(statement, sql.Composable) else statement
+        self.connection.log.append(' '.join(text.split()[:2]))
+        if text.startswith('CREATE TABLE') and self.connection.existing:
+            raise psycopg2.errors.DuplicateTable()
+        self.rows = [(bound,) for bound in self.connection.bounds]
+
+    def fetchall(self):
+        return self.rows
+
+    def copy_expert(self, statement, file):
+        content = file.read()
+        if f'\n{self.connection.failing_value}\n' in f'\n{content}':
+            raise psycopg2.errors.QueryCanceled()
+        self.connection.log.append(f'COPY {render(statement).split()[1]} {content.count(chr(10))}')
+
+
+class LoadConnection:
+    autocommit = True
+
+    def __init__(self, log, bounds=(), existing=False, failing_value=None):
+        self.log = log
+        self.bounds = bounds
+        self.existing = existing
+        self.failing_value = failing_value
+
+    def cursor(self):
+        return LoadCursor(self)
+
+    def commit(self):
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+
+
+class LoadPool:
+    def __init__(self, **kwargs):
+        self.log = []
+        self.kwargs = kwargs
+
+    def getconn(self):
+        return LoadConnection(self.log, **self.kwargs)
+
+    def putconn(self, connection, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+def load(lookup, monkeypatch, data, **kwargs):
+    pool = LoadPool(**kwargs.pop('pool', {}))
+    monkeypatch.setattr(lookup, '_get_pool', lambda n_connections: pool)
+    monkeypatch.setattr(lookup, '_get_table_fields', lambda schema, table: list(data.columns))
+    return lookup.parallel_insert('dashboards', 't', data, **kwargs), pool.log
+
+
+def test_parallel_insert_copies_shards_straight_into_target(lookup, monkeypatch):
+    data = pd.DataFrame({'ticket_id': range(100)})
+    status, log = load(lookup, monkeypatch, data, shard_key='ticket_id', n_connections=4)
+    assert status == TransactionStatus.Success
+    copies = [entry for entry in log if entry.startswith('COPY')]
+    assert len(copies) == 4 and all(entry.startswith('COPY dashboards.t ') for entry in copies)
+    assert sum(int(entry.split()[-1]) for entry in copies) == 100
+    assert not [entry for entry in log if entry.startswith(('CREATE', 'INSERT'))]
+
+
+def test_parallel_insert_reports_failed_shard(lookup, monkeypatch):
+    data = pd.DataFrame({'ticket_id': range(100)})
+    status, log = load(
+        lookup, monkeypatch, data, shard_key='ticket_id', n_connections=4, pool={'failing_value': 13}
+    )
+    assert status == TransactionStatus.Fail
+    copies = [entry for entry in log if entry.startswith('COPY')]
+    assert len(copies) == 3
+    assert sum(int(entry.split()[-1]) for entry in copies) < 100
+
+
+def test_parallel_insert_attaches_new_partitions(lookup, monkeypatch):
+    data = pd.DataFrame({'created_at': pd.date_range('2023-01-01', periods=48, freq='H')})
+    status, log = load(
+        lookup, monkeypatch, data, shard_key='created_at', shard_by='day', partitioned=True,
+        pool={'bounds': ["FOR VALUES FROM ('2023-01-01') TO ('2023-01-02')"]}
+    )
+    assert status == TransactionStatus.Success
+    assert 'COPY dashboards.t 24' in log
+    assert 'COPY dashboards.t_p20230102 24' in log
+    assert log[-2:] == ['ALTER TABLE', 'COMMIT']
+
+
+def test_parallel_insert_keeps_existing_table_on_name_clash(lookup, monkeypatch):
+    data = pd.DataFrame({'created_at': pd.date_range('2023-01-01', periods=24, freq='H')})
+    status, log = load(
+        lookup, monkeypatch, data, shard_key='created_at', shard_by='day', partitioned=True,
+        pool={'existing': True}
+    )
+    assert status == TransactionStatus.Fail
+    assert not [entry for entry in log if entry.startswith('DROP')]